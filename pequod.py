@@ -4,10 +4,21 @@
 Build container images of the various components and push them to a registry.
 """
 
-from datetime import datetime
 from io import BytesIO, StringIO
-from itertools import chain
+import atexit
+import contextlib
+import functools
+import glob
+import hashlib
+import json
+import mmap
+import pickle
+import re
+import shutil
 import subprocess
+import tempfile
+import time
+import weakref
 
 import os
 import sys
@@ -19,53 +30,59 @@ import asyncio
 def get_image_tag_from_git_commit():
     describe_args = ['git', 'describe', '--exclude=*', '--always',
                      '--abbrev=40', '--dirty']
-    p = subprocess.run(describe_args, stdout=subprocess.PIPE)
-    tag = p.stdout.decode('utf-8').strip()
+    p = subprocess.run(resolve_command(describe_args), capture_output=True,
+                       text=True, check=False, close_fds=False)
+    tag = p.stdout.strip()
     if tag.endswith('-dirty'):
-        timestamp = datetime.utcnow().strftime('%Y%m%d-%H%M%S')
+        timestamp = time.strftime('%Y%m%d-%H%M%S', time.gmtime())
         tag = f'{tag}-{timestamp}'
     return tag
 
 
-DEFAULT_IMAGE_TAG = get_image_tag_from_git_commit()
+@functools.lru_cache(maxsize=1)
+def default_image_tag():
+    # Only computed when a command actually needs a tag, so that e.g.
+    # `info` doesn't have to run git.
+    return get_image_tag_from_git_commit()
 
 
-def run(config):
-    PEQUOD_REGISTRY_URL = os.getenv('PEQUOD_REGISTRY_URL')
-    PEQUOD_LOGIN_USERNAME = os.getenv('PEQUOD_LOGIN_USERNAME')
-    PEQUOD_LOGIN_PASSWORD = os.getenv('PEQUOD_LOGIN_PASSWORD')
+def default_registry_url():
+    # Looked up when a command runs rather than when the parser is built, so
+    # that the environment is read at the point it's actually needed.
+    return (get_config().get('registry_url') or
+            os.environ.get('PEQUOD_REGISTRY_URL'))
 
-    PEQUOD_POST_COMMAND = os.getenv('PEQUOD_POST_COMMAND')
-
-    if 'registry_url' not in config or not config['registry_url']:
-        config['registry_url'] = PEQUOD_REGISTRY_URL
 
+def run():
     parser = argparse.ArgumentParser()
 
     subs = parser.add_subparsers(dest='command', title='Available commands')
 
-    def format_envvar(s):
-        if s is None:
-            return 'unset'
-        return '"{}"'.format(s)
+    # Only set up the subcommand that's actually being run. With no command,
+    # or something that isn't one (e.g. --help or a typo), set up all of
+    # them, so that the help and error messages list every command.
+    commands = ('build', 'push', 'bp', 'flake', 'test', 'info')
+    selected = sys.argv[1] if len(sys.argv) > 1 else None
+    if selected not in commands:
+        selected = None
+
+    def wanted(name):
+        return selected is None or selected == name
 
     # login_s = subs.add_parser('login')
     # login_s.add_argument(
     #     '--registry-url',
-    #     default=PEQUOD_REGISTRY_URL,
     #     help='The base url for the registry to push to. Usually a FQDN. '
-    #          'Defaults to the value of the PEQUOD_REGISTRY_URL env var '
-    #          '(currently {}).'.format(format_envvar(PEQUOD_REGISTRY_URL)))
+    #          'Defaults to the value of the `registry_url` key in the '
+    #          'config, or the PEQUOD_REGISTRY_URL env var.')
     # login_s.add_argument(
     #     '--username',
     #     help='The username to use for logging in. Defaults to the value of '
-    #          'the PEQUOD_LOGIN_USERNAME env var '
-    #          '(currently {}).'.format(format_envvar(PEQUOD_LOGIN_USERNAME)))
+    #          'the PEQUOD_LOGIN_USERNAME env var.')
     # login_s.add_argument(
     #     '--password',
     #     help='The password to use for logging in. Defaults to the value of '
-    #          'the PEQUOD_LOGIN_PASSWORD env var '
-    #          '(currently {}).'.format(format_envvar(PEQUOD_LOGIN_PASSWORD)))
+    #          'the PEQUOD_LOGIN_PASSWORD env var.')
     # login_s.add_argument(
     #     '--password-stdin', action='store_true',
     #     help='Take the password to use for logging in from STDIN.')
@@ -76,124 +93,189 @@ def run(config):
     #                                                   _args.password_stdin),
     #                      on_post='login complete')
 
-    build_s = subs.add_parser('build',
-                              help='Build one or more component images.')
-    build_s.add_argument('components', choices=component_choices, nargs='*')
-    build_s.add_argument(
-        '--version-tag',
-        default=DEFAULT_IMAGE_TAG,
-        help=f'A value to set as the VERSION_TAG build argument when running'
-             f' `docker build` Changing this is not recommended. Defaults to'
-             f' a string based on the current time and git commit description'
-             f' ("{DEFAULT_IMAGE_TAG}").')
-    build_s.set_defaults(func=cmd_build,
-                         on_post='build complete')
-
-    push_s = subs.add_parser(
-        'push', help='Push one or more component images to the registry.')
-    push_s.add_argument('components', choices=component_choices, nargs='*')
-    push_s.add_argument(
-        '--registry-url',
-        default=config['registry_url'],
-        help='The base url for the registry to push to. Usually a FQDN. '
-             'Defaults to the value of the `registry_url` key in the config, '
-             'or the PEQUOD_REGISTRY_URL env var '
-             '(currently {}).'.format(format_envvar(config['registry_url'])))
-    push_s.add_argument(
-        '--image-tag',
-        default=DEFAULT_IMAGE_TAG,
-        help='The tag for the docker image, e.g. "1.0" or "2.3.4-rev5-alpha" '
-             'or "stable" or "latest". Defaults to a string based on the '
-             'current time and git commit description.')
-    push_s.set_defaults(
-        func=cmd_push,
-        on_post='push complete')
-
-    bp_s = subs.add_parser(
-        'bp', help='Both build and push selected component images')
-    bp_s.add_argument('components', choices=component_choices, nargs='*')
-    bp_s.add_argument(
-        '--registry-url',
-        default=PEQUOD_REGISTRY_URL,
-        help='The base url for the registry to push to. Usually a FQDN. '
-             'Defaults to the value of the PEQUOD_REGISTRY_URL env var '
-             '(currently {}).'.format(format_envvar(PEQUOD_REGISTRY_URL)))
-    bp_s.add_argument(
-        '--image-tag',
-        default=DEFAULT_IMAGE_TAG,
-        help='The tag for the docker image, e.g. "1.0" or "2.3.4-rev5-alpha" '
-             'or "stable" or "latest". Defaults to a string based on the '
-             'current time and git commit description.')
-    bp_s.set_defaults(func=cmd_build_and_push,
-                      on_post='build and push complete')
-
-    flake_s = subs.add_parser('flake', help='Run flake8 on the source files.')
-    # TODO: specify components
-    flake_s.set_defaults(func=lambda _args: cmd_flake(),
-                         on_post='flake 8 complete')
-
-    test_s = subs.add_parser('test', help='Run the unit tests.')
-    # TODO: specify components
-    test_s.set_defaults(func=lambda _args: cmd_test(),
-                        on_post='unit tests complete')
-
-    info_s = subs.add_parser(
-        'info',
-        help='Display info about the configured components.')
-    info_s.set_defaults(func=cmd_info)
+    if wanted('build'):
+        build_s = subs.add_parser('build',
+                                  help='Build one or more component images.',
+                                  epilog=CONCURRENCY_HELP)
+        add_shared_args(build_s, 'components')
+        build_s.add_argument(
+            '--version-tag',
+            default=None,
+            help='A value to set as the VERSION_TAG build argument when '
+                 'running `docker build` Changing this is not recommended. '
+                 'Defaults to a string based on the current time and git '
+                 'commit description ("<computed from git>").')
+        build_s.add_argument(
+            '--use-buildx', action=argparse.BooleanOptionalAction,
+            default=True,
+            help='Build with `docker buildx build` (BuildKit) instead of the '
+                 'classic `docker build`. Enabled by default.')
+        add_shared_args(build_s, '--prewarm', '--layer-cache')
+        build_s.set_defaults(func=cmd_build,
+                             on_post='build complete')
+
+    if wanted('push'):
+        push_s = subs.add_parser(
+            'push', help='Push one or more component images to the registry.',
+            epilog=CONCURRENCY_HELP)
+        add_shared_args(push_s, 'components', '--registry-url', '--image-tag')
+        push_s.set_defaults(
+            func=cmd_push,
+            on_post='push complete')
+
+    if wanted('bp'):
+        bp_s = subs.add_parser(
+            'bp', help='Both build and push selected component images',
+            epilog=CONCURRENCY_HELP)
+        add_shared_args(bp_s, 'components', '--registry-url', '--image-tag')
+        bp_s.add_argument(
+            '--use-buildx', action=argparse.BooleanOptionalAction,
+            default=True,
+            help='Build and push in a single `docker buildx build --push` '
+                 'instead of separate `docker build` and `docker push` steps. '
+                 'Enabled by default.')
+        bp_s.add_argument(
+            '--bake', action=argparse.BooleanOptionalAction, default=True,
+            help='With --use-buildx, build and push the selected components '
+                 'in `docker buildx bake` sessions of up to '
+                 'PEQUOD_BUILD_CONCURRENCY components each, instead of a '
+                 'separate `docker buildx build` per component. Enabled by '
+                 'default.')
+        bp_s.add_argument(
+            '--compression', choices=['gzip', 'zstd'], default='gzip',
+            help='The compression to use for the pushed image layers. zstd '
+                 'compresses in parallel and is considerably faster for large '
+                 'layers, but requires --use-buildx. Defaults to gzip.')
+        add_shared_args(bp_s, '--prewarm', '--layer-cache')
+        bp_s.set_defaults(func=cmd_build_and_push,
+                          on_post='build and push complete')
+
+    if wanted('flake'):
+        flake_s = subs.add_parser('flake',
+                                  help='Run flake8 on the source files.')
+        # TODO: specify components
+        flake_s.set_defaults(func=cmd_flake,
+                             on_post='flake 8 complete')
+
+    if wanted('test'):
+        test_s = subs.add_parser('test', help='Run the unit tests.')
+        # TODO: specify components
+        test_s.set_defaults(func=cmd_test,
+                            on_post='unit tests complete')
+
+    if wanted('info'):
+        info_s = subs.add_parser(
+            'info',
+            help='Display info about the configured components.')
+        info_s.set_defaults(func=cmd_info)
 
     args = parser.parse_args()
 
     if 'func' in args:
+        # Option combinations that argparse can't express on its own.
+        command_parser = subs.choices[args.command]
+        if (getattr(args, 'compression', 'gzip') != 'gzip' and
+                not args.use_buildx):
+            command_parser.error(
+                f'--compression {args.compression} requires --use-buildx')
+        if getattr(args, 'layer_cache', False) and not args.use_buildx:
+            command_parser.error('--layer-cache requires --use-buildx')
+        if args.command in ('build', 'push', 'bp'):
+            for envvar in CONCURRENCY_DEFAULTS:
+                try:
+                    get_concurrency_limit(envvar)
+                except ValueError as e:
+                    command_parser.error(str(e))
+        post_command = os.environ.get('PEQUOD_POST_COMMAND')
+        if post_command and 'on_post' in args and args.on_post:
+            post_command = post_command.split() + args.on_post.split()
+        else:
+            post_command = None
         kwargs = vars(args)
-        args.func(**kwargs)
-        if PEQUOD_POST_COMMAND and 'on_post' in args and args.on_post:
-            cmd = PEQUOD_POST_COMMAND.split() + args.on_post.split()
-            run_external_command(cmd, print, print)
+        result = args.func(**kwargs)
+        if asyncio.iscoroutine(result):
+            rcs = asyncio.run(run_with_post_command(result, post_command))
+        else:
+            rcs = [result or 0]
+            if post_command and not any(rcs):
+                run_external_command(post_command, mkprint(),
+                                     mkprint(file=sys.stderr))
+        if any(rcs):
+            sys.exit(max(rcs, key=abs))
     else:
         parser.print_help()
 
-    loop.close()
 
-
-def cmd_build(components, **kwargs):
+def cmd_build(components, version_tag=None, use_buildx=True, prewarm=False,
+              layer_cache=False, **kwargs):
+    version_tag = version_tag or default_image_tag()
     components = normalize_components(components)
-    futures = []
-    for comp in components:
-        if not comp.is_supported:
-            print("{} is not currently supported".format(comp.name))
-            continue
-        futures.append(build_image(comp))
-    run_multiple_futures(futures)
+    futures = [build_image(comp, version_tag, use_buildx, layer_cache)
+               for comp in components]
+    result = run_multiple_futures(futures)
+    if prewarm:
+        result = run_after_prewarm(components, result)
+    return result
 
 
 def cmd_push(components, registry_url, image_tag, **kwargs):
+    registry_url = registry_url or default_registry_url()
+    image_tag = image_tag or default_image_tag()
     components = normalize_components(components)
-    futures = []
-    for comp in components:
-        if not comp.is_supported:
-            print("{} is not currently supported".format(comp.name))
-            continue
-        futures.append(tag_and_push_image(comp, registry_url, image_tag))
-    run_multiple_futures(futures)
-
-
-def cmd_build_and_push(components, registry_url, image_tag, **kwargs):
+    futures = [tag_and_push_image(comp, registry_url, image_tag)
+               for comp in components]
+    return run_multiple_futures(futures)
+
+
+def cmd_build_and_push(components, registry_url, image_tag, use_buildx=True,
+                       bake=True, compression='gzip', prewarm=False,
+                       layer_cache=False, **kwargs):
+    if use_buildx and bake:
+        return cmd_build_and_push_bake(components, registry_url, image_tag,
+                                       compression, prewarm, layer_cache)
+    registry_url = registry_url or default_registry_url()
+    image_tag = image_tag or default_image_tag()
+    components = normalize_components(components)
+    futures = [build_and_tag_and_push_image(comp, registry_url, image_tag,
+                                            use_buildx, compression,
+                                            layer_cache)
+               for comp in components]
+    result = run_multiple_futures(futures)
+    if prewarm:
+        result = run_after_prewarm(components, result)
+    return result
+
+
+def cmd_build_and_push_bake(components, registry_url, image_tag,
+                            compression='gzip', prewarm=False,
+                            layer_cache=False, **kwargs):
+    registry_url = registry_url or default_registry_url()
+    image_tag = image_tag or default_image_tag()
     components = normalize_components(components)
-    futures = []
+    targets = {}
     for comp in components:
-        if not comp.is_supported:
-            print("{} is not currently supported".format(comp.name))
-            continue
-        futures.append(build_and_tag_and_push_image(comp, registry_url,
-                                                    image_tag))
-    run_multiple_futures(futures)
+        # Bake target names are restricted, so e.g. `a.b` and `a_b` would
+        # end up the same; number any repeats to keep them apart.
+        base = name = re.sub(r'[^\w-]', '_', comp.name)
+        n = 1
+        while name in targets:
+            n += 1
+            name = f'{base}_{n}'
+        targets[name] = get_bake_target(comp, registry_url, image_tag,
+                                        compression, layer_cache)
+    result = bake_images(targets)
+    if prewarm:
+        result = run_after_prewarm(components, result)
+    return result
 
 
 def cmd_login(registry_url, username, password,
               password_stdin, **kwargs):
+    registry_url = registry_url or default_registry_url()
+    username = username or os.environ.get('PEQUOD_LOGIN_USERNAME')
     if not password and password_stdin:
         password = sys.stdin.read().splitlines()[0]
+    password = password or os.environ.get('PEQUOD_LOGIN_PASSWORD')
 
     stdout = mkprint("oc login")
     stderr = mkprint("oc login", file=sys.stderr)
@@ -202,46 +284,61 @@ def cmd_login(registry_url, username, password,
         'docker', 'login', 'url', '--username={}'.format(username),
         '--password={}'.format(password)
     ]
-    run_external_command(cmd_args, stdout_cb=stdout, stderr_cb=stderr)
-
-    token = [None]
-
-    def capture(line):
-        token[0] = line.strip()
+    p = run_short_command(cmd_args, stdout_cb=stdout, stderr_cb=stderr)
+    if p.returncode:
+        return p.returncode
 
-    run_external_command(['oc', 'whoami', '-t'],
-                         stdout_cb=capture,
-                         stderr_cb=lambda x: None)
+    p = run_short_command(['oc', 'whoami', '-t'],
+                          stderr_cb=mkprint("oc whoami", file=sys.stderr))
+    if p.returncode:
+        return p.returncode
+    token = p.stdout.strip().decode('utf-8')
 
     stdout2 = mkprint("docker login")
     stderr2 = mkprint("docker login", file=sys.stderr)
-    cmd_args = ['docker', 'login', '-p', token[0], '-u', 'unused',
+    cmd_args = ['docker', 'login', '-p', token, '-u', 'unused',
                 registry_url]
-    run_external_command(cmd_args, stdout_cb=stdout2, stderr_cb=stderr2)
+    p = run_short_command(cmd_args, stdout_cb=stdout2, stderr_cb=stderr2)
+    return p.returncode
 
 
-def cmd_flake(**kwargs):
-    stdout = mkprint("flake")
-    stderr = mkprint("flake", file=sys.stderr)
+FLAKE_ARGS = ['example1', 'example2', 'pequod.py']
+TEST_ARGS = ['--cov=example1', '--cov=example2', '--cov=pequod',
+             '--cov-branch', '--cov-report', 'html', 'tests/']
 
-    run_external_command(
-        ['flake8', 'example1', 'example2', 'pequod.py'],
-        stdout_cb=stdout,
-        stderr_cb=stderr)
 
+def cmd_flake(**kwargs):
+    # Run flake8 in this interpreter when it's importable, rather than
+    # paying for a second interpreter start-up. Fall back to the executable
+    # when it isn't installed alongside pequod.
+    try:
+        from flake8.main.application import Application
+    except ImportError:
+        return run_external_command(
+            ['flake8'] + FLAKE_ARGS,
+            stdout_cb=mkprint("flake"),
+            stderr_cb=mkprint("flake", file=sys.stderr))
+    app = Application()
+    app.run(FLAKE_ARGS)
+    return app.exit_code()
 
-def cmd_test(**kwargs):
-    stdout = mkprint("test")
-    stderr = mkprint("test", file=sys.stderr)
 
-    run_external_command(
-        ['python', '-m', 'pytest', '--cov=example1', '--cov=example2',
-         '--cov=pequod', '--cov-branch', '--cov-report', 'html', 'tests/'],
-        stdout_cb=stdout,
-        stderr_cb=stderr)
+def cmd_test(**kwargs):
+    # Test runs shouldn't leave .pyc files behind in the source tree.
+    try:
+        import pytest
+    except ImportError:
+        return run_external_command(
+            ['python', '-m', 'pytest'] + TEST_ARGS,
+            stdout_cb=mkprint("test"),
+            stderr_cb=mkprint("test", file=sys.stderr),
+            env=dict(os.environ, PYTHONDONTWRITEBYTECODE='1'))
+    sys.dont_write_bytecode = True
+    return int(pytest.main(TEST_ARGS))
 
 
 def cmd_info(*args, **kwargs):
+    component_items_by_name = get_component_items_by_name()
     components = set(_ for _ in component_items_by_name.values()
                      if isinstance(_, Component))
     components = list(sorted(components, key=lambda _: _.name))
@@ -270,6 +367,9 @@ def cmd_info(*args, **kwargs):
 
 
 class Component:
+    __slots__ = ('name', 'image_name', 'dockerfile', 'comp_type',
+                 'context_folder', 'aliases', 'is_supported', 'depends_on')
+
     def __init__(self, name, image_name, dockerfile, comp_type=None,
                  context_folder=None, aliases=None, depends_on=None):
         self.name = name
@@ -295,13 +395,16 @@ class Component:
         return 'Component(\'{}\')'.format(self.name)
 
     def get_components(self):
-        return [self]
+        return (self,)
 
 
 class ComponentGroup:
+    __slots__ = ('name', 'includes', 'aliases', '_flat')
+
     def __init__(self, name, includes, aliases=None):
         self.name = name
         self.includes = list(includes)
+        self._flat = None
         if aliases is None:
             aliases = []
         self.aliases = list(aliases)
@@ -310,17 +413,24 @@ class ComponentGroup:
         return 'ComponentGroup(\'{}\')'.format(self.name)
 
     def get_components(self):
-        return [comp
-                for item in self.includes
-                for comp in item.get_components()]
+        if self._flat is None:
+            self._flat = [comp
+                          for item in self.includes
+                          for comp in item.get_components()]
+        return self._flat
 
 
 def load_config_file(conf_file=None):
     if conf_file is None:
         conf_file = 'pequod.yaml'
     import yaml
-    with open(conf_file) as f:
-        return yaml.load(f, Loader=yaml.Loader)
+    try:
+        from yaml import CSafeLoader as SafeLoader
+    except ImportError:
+        from yaml import SafeLoader
+    with open(conf_file, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return yaml.load(data, Loader=SafeLoader)
 
 
 def load_components(config):
@@ -372,32 +482,219 @@ def load_components(config):
     return items_by_name
 
 
-config = load_config_file()
-component_items_by_name = load_components(config)
-component_choices = sorted(component_items_by_name.keys())
+def get_cache_dir():
+    base = os.getenv('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'pequod')
+
+
+def load_config_and_components(conf_file=None):
+    # Parsing the config and building the components is cached on disk,
+    # keyed on the config file's mtime and size. The rest of the key covers
+    # anything that would make an old pickle unusable: the path, this
+    # script's own mtime (the classes may have changed), and the module name
+    # the classes were pickled under.
+    if conf_file is None:
+        conf_file = 'pequod.yaml'
+    st = os.stat(conf_file)
+    key = '\0'.join([os.path.abspath(conf_file), __name__,
+                     str(os.stat(__file__).st_mtime_ns)])
+    key_hash = hashlib.sha1(key.encode('utf-8')).hexdigest()[:8]
+    cache_dir = get_cache_dir()
+    cache_file = os.path.join(
+        cache_dir,
+        f'components-{st.st_mtime_ns}-{st.st_size}-{key_hash}.pkl')
+    try:
+        with open(cache_file, 'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        pass
+
+    config = load_config_file(conf_file)
+    items_by_name = load_components(config)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        for stale in glob.glob(os.path.join(cache_dir,
+                                            f'components-*-{key_hash}.pkl')):
+            os.remove(stale)
+        with tempfile.NamedTemporaryFile('wb', dir=cache_dir,
+                                         delete=False) as f:
+            pickle.dump((config, items_by_name), f)
+        os.replace(f.name, cache_file)
+    except OSError:
+        pass
+    return config, items_by_name
+
+
+@functools.lru_cache(maxsize=1)
+def get_config_and_components():
+    # Loaded on first use, so that commands which don't deal with components
+    # (e.g. `flake`) never read the config.
+    return load_config_and_components()
+
+
+def get_config():
+    return get_config_and_components()[0]
+
+
+def get_component_items_by_name():
+    return get_config_and_components()[1]
+
+
+def component_name(name):
+    component_items_by_name = get_component_items_by_name()
+    if name not in component_items_by_name:
+        choices = ', '.join(repr(_) for _ in sorted(component_items_by_name))
+        raise argparse.ArgumentTypeError(
+            f'invalid choice: {name!r} (choose from {choices})')
+    return name
+
+
+# Arguments that several of the subcommands take, by name.
+SHARED_ARGS = {
+    'components': dict(
+        type=component_name, nargs='*',
+        help='The components or groups to operate on. Run `info` to list '
+             'them.'),
+    '--registry-url': dict(
+        help='The base url for the registry to push to. Usually a FQDN. '
+             'Defaults to the value of the `registry_url` key in the config, '
+             'or the PEQUOD_REGISTRY_URL env var.'),
+    '--image-tag': dict(
+        help='The tag for the docker image, e.g. "1.0" or "2.3.4-rev5-alpha" '
+             'or "stable" or "latest". Defaults to a string based on the '
+             'current time and git commit description '
+             '("<computed from git>").'),
+    '--prewarm': dict(
+        action=argparse.BooleanOptionalAction, default=False,
+        help='Pull all of the base images named in the components\' '
+             'Dockerfiles concurrently before starting to build. Off by '
+             'default.'),
+    '--layer-cache': dict(
+        action=argparse.BooleanOptionalAction, default=False,
+        help='Keep a local BuildKit layer cache for each component under '
+             'the pequod cache dir, and reuse it across builds. Requires '
+             '--use-buildx, and a builder that can export caches (e.g. the '
+             'docker-container driver). Off by default.'),
+}
+
+
+def add_shared_args(parser, *names):
+    for name in names:
+        parser.add_argument(name, **SHARED_ARGS[name])
+
+
+# Output buffers from mkprint that have something in them, by id(). They're
+# all written out shortly after something is added, whenever a subprocess
+# finishes, and at exit.
+_unflushed_output = {}
+
+# How long buffered output may wait before being written, in seconds.
+OUTPUT_FLUSH_INTERVAL = 0.5
+
+# The (loop, timer handle) of the pending timed flush, if there is one.
+_flush_timer = None
+
+
+def _write_output(file, fd, buf):
+    file.flush()
+    with memoryview(buf) as data:
+        written = 0
+        while written < len(data):
+            written += os.write(fd, data[written:])
+    buf.clear()
+
+
+def flush_output():
+    global _flush_timer
+    if _flush_timer is not None:
+        _flush_timer[1].cancel()
+        _flush_timer = None
+    for file, fd, buf in list(_unflushed_output.values()):
+        _write_output(file, fd, buf)
+    _unflushed_output.clear()
+
+
+def _schedule_flush():
+    # Outside of an event loop, the caller flushes as soon as its command is
+    # done (see run_short_command).
+    global _flush_timer
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    if _flush_timer is not None and _flush_timer[0] is loop:
+        return
+    _flush_timer = (loop, loop.call_later(OUTPUT_FLUSH_INTERVAL,
+                                          flush_output))
+
+
+atexit.register(flush_output)
 
 
 def mkprint(label=None, file=None):
+    # The returned callable takes the raw bytes of a subprocess's output,
+    # in whole lines.
     if file is None:
         file = sys.stdout
 
-    def _print(s, *args, **kwargs):
-        if isinstance(s, bytes):
-            s = s.decode('utf-8')
-        if label is not None:
-            s = '{}: {}'.format(label, s)
-        print(s, end='', file=file, *args, **kwargs)
+    try:
+        fd = file.fileno()
+    except (AttributeError, OSError):
+        fd = None
+
+    if fd is None:
+        def write(data):
+            file.write(data.decode('utf-8'))
+    elif file.isatty():
+        # Someone is watching, so write each batch of lines straight away.
+        buf = bytearray()
+
+        def write(data):
+            buf.extend(data)
+            _write_output(file, fd, buf)
+    else:
+        # Collect the output and write it to the fd in large pieces. Nothing
+        # waits longer than OUTPUT_FLUSH_INTERVAL, so that logs of a long
+        # build still show progress, and little is lost if pequod is killed.
+        limit = 1 << 20
+        buf = bytearray()
+
+        def write(data):
+            buf.extend(data)
+            if len(buf) > limit:
+                _write_output(file, fd, buf)
+                _unflushed_output.pop(id(buf), None)
+            else:
+                _unflushed_output[id(buf)] = (file, fd, buf)
+                _schedule_flush()
+
+    if label is None:
+        return write
+
+    prefix = '{}: '.format(label).encode('utf-8')
+
+    def _print(s):
+        write(b''.join(prefix + line for line in s.splitlines(keepends=True)))
 
     return _print
 
 
 async def read_stream(stream, cb):
+    # Read in large chunks, but only ever give the callback whole lines (bar
+    # an unterminated last line), possibly several at a time.
+    pending = bytearray()
     while True:
-        line = await stream.readline()
-        if line:
-            cb(line)
-        else:
+        chunk = await stream.read(65536)
+        if not chunk:
+            if pending and cb is not None:
+                cb(bytes(pending))
             break
+        pending.extend(chunk)
+        end = pending.rfind(b'\n') + 1
+        if end:
+            if cb is not None:
+                cb(bytes(pending[:end]))
+            del pending[:end]
 
 
 async def write_stream(stream, cb):
@@ -405,38 +702,46 @@ async def write_stream(stream, cb):
         return
     while True:
         line = cb()
-        if line:
-            await stream.writeline()
-        else:
+        if not line:
             break
-
-
-async def stream_subprocess(cmd, stdout_cb, stderr_cb, stdin_cb=None):
+        if isinstance(line, str):
+            line = line.encode('utf-8')
+        stream.write(line)
+        await stream.drain()
+    stream.close()
+
+
+async def stream_subprocess(cmd, stdout_cb, stderr_cb, stdin_cb=None,
+                            merge_streams=True, env=None):
+    # With merge_streams, the process's stderr goes into the same pipe as
+    # stdout and everything is passed to stdout_cb. That's one reader instead
+    # of two, and keeps the relative order of the output.
+    if merge_streams:
+        stderr = asyncio.subprocess.STDOUT
+    else:
+        stderr = asyncio.subprocess.PIPE
     process = await asyncio.create_subprocess_exec(
-        *cmd,
+        *resolve_command(cmd, env),
         stdin=asyncio.subprocess.PIPE,
         stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE)
-
-    awaitables = [
-        read_stream(process.stdout, stdout_cb),
-        read_stream(process.stderr, stderr_cb),
-    ]
+        stderr=stderr,
+        env=env,
+        close_fds=False)
+
+    # Wait for the process alongside draining its pipes, so that neither
+    # side can block the other on a full pipe buffer.
+    awaitables = [process.wait(), read_stream(process.stdout, stdout_cb)]
+    if not merge_streams:
+        awaitables.append(read_stream(process.stderr, stderr_cb))
     if stdin_cb:
         awaitables.append(write_stream(process.stdin, stdin_cb))
-    await asyncio.wait(awaitables)
-    return await process.wait()
-
-
-async def wait_multiple(targets):
-    await asyncio.wait(targets)
-
-
-loop = asyncio.get_event_loop()
+    rc, *_ = await asyncio.gather(*awaitables)
+    flush_output()
+    return rc
 
 
 def run_external_command(command_args, stdout_cb=None, stderr_cb=None,
-                         stdin=None):
+                         stdin=None, merge_streams=True, env=None):
     # https://kevinmccarthy.org/2016/07/25/streaming-subprocess-stdin-and-
     # stdout-with-asyncio-in-python/
 
@@ -445,61 +750,313 @@ def run_external_command(command_args, stdout_cb=None, stderr_cb=None,
     if isinstance(stdin, str):
         stdin = StringIO(stdin).readline
 
-    rc = loop.run_until_complete(
-        stream_subprocess(command_args, stdout_cb, stderr_cb, stdin_cb=stdin)
+    rc = asyncio.run(
+        stream_subprocess(command_args, stdout_cb, stderr_cb, stdin_cb=stdin,
+                          merge_streams=merge_streams, env=env)
     )
     return rc
 
 
-def run_multiple_futures(futures):
-    rc = loop.run_until_complete(asyncio.wait(futures))
-    return rc
+def resolve_command(command_args, env=None):
+    # subprocess only uses posix_spawn instead of fork+exec when it's given
+    # a path to the executable (and close_fds=False, which is safe as our own
+    # fds are non-inheritable), not a bare name to look up. Look it up the
+    # way exec would, in the child's PATH. If it can't be found, leave it for
+    # subprocess to report.
+    path = (os.environ if env is None else env).get('PATH')
+    executable = shutil.which(command_args[0], path=path)
+    if executable is None:
+        return list(command_args)
+    return [executable] + list(command_args[1:])
+
+
+def run_short_command(command_args, stdout_cb=None, stderr_cb=None):
+    # For quick commands whose output doesn't need to be streamed, without
+    # spinning up an event loop.
+    p = subprocess.run(resolve_command(command_args), capture_output=True,
+                       close_fds=False)
+    for output, cb in ((p.stdout, stdout_cb), (p.stderr, stderr_cb)):
+        if cb is not None and output:
+            cb(output)
+    flush_output()
+    return p
+
+
+async def run_with_post_command(awaitable, post_command=None):
+    # The image commands give back the return code of each component's
+    # pipeline. The post command runs on the same event loop, and only if
+    # they all succeeded.
+    rcs = await awaitable
+    if post_command and not any(rcs):
+        await stream_subprocess(post_command, mkprint(),
+                                mkprint(file=sys.stderr))
+    return rcs
+
+
+async def run_multiple_futures(futures):
+    # All of the components' pipelines are scheduled together, so that e.g.
+    # the push of one component can overlap with the build of another. The
+    # steps within a single component's pipeline still run in order.
+    return await asyncio.gather(*futures)
+
+
+# Running too many builds at once makes them slower overall, as they contend
+# for dockerd and the disk; pushes are mostly waiting on the network and can
+# run wider. On top of that, PEQUOD_PARALLEL caps the total number of docker
+# processes, to avoid fork failures and thrashing on long component lists.
+CONCURRENCY_DEFAULTS = {
+    'PEQUOD_BUILD_CONCURRENCY': 2,
+    'PEQUOD_PUSH_CONCURRENCY': 8,
+    'PEQUOD_PARALLEL': max(1, (os.cpu_count() or 2) - 2),
+}
+
+CONCURRENCY_HELP = (
+    'At most PEQUOD_BUILD_CONCURRENCY builds '
+    '(default {PEQUOD_BUILD_CONCURRENCY}) and PEQUOD_PUSH_CONCURRENCY pushes '
+    '(default {PEQUOD_PUSH_CONCURRENCY}) run at once, and at most '
+    'PEQUOD_PARALLEL docker commands in total '
+    '(default {PEQUOD_PARALLEL}, i.e. the number of CPUs minus two).'
+).format(**CONCURRENCY_DEFAULTS)
+
+_semaphores = weakref.WeakKeyDictionary()
+
+
+def get_semaphore(envvar):
+    # A semaphore can only be waited on from a single event loop, and
+    # asyncio.run() makes a new loop every time, so keep a set per loop.
+    semaphores = _semaphores.setdefault(asyncio.get_running_loop(), {})
+    if envvar not in semaphores:
+        semaphores[envvar] = asyncio.Semaphore(get_concurrency_limit(envvar))
+    return semaphores[envvar]
+
+
+def get_concurrency_limit(envvar):
+    value = os.getenv(envvar)
+    if value is None:
+        return CONCURRENCY_DEFAULTS[envvar]
+    try:
+        limit = int(value)
+    except ValueError:
+        limit = 0
+    # A limit of zero would wait forever for a slot.
+    if limit < 1:
+        raise ValueError(f'{envvar} must be a whole number of at least 1, '
+                         f'not {value!r}')
+    return limit
+
+
+@contextlib.asynccontextmanager
+async def docker_slot(envvar=None):
+    # Always take the per-kind semaphore before the overall one, so that
+    # nothing holds an overall slot while waiting for its kind.
+    async with contextlib.AsyncExitStack() as stack:
+        if envvar is not None:
+            await stack.enter_async_context(get_semaphore(envvar))
+        await stack.enter_async_context(get_semaphore('PEQUOD_PARALLEL'))
+        yield
 
 
 def compose_image_operation_command(comp, registry_url=None,
-                                    build=False, push=False, image_tag=None):
+                                    build=False, push=False, image_tag=None,
+                                    use_buildx=False, compression='gzip',
+                                    layer_cache=False):
     stdout = mkprint(label=comp.image_name)
     stderr = mkprint(label=comp.image_name, file=sys.stderr)
     if image_tag is None:
-        image_tag = DEFAULT_IMAGE_TAG
+        image_tag = default_image_tag()
     full_image_name = '{}/{}:{}'.format(registry_url,
                                         comp.image_name, image_tag)
-    if build and push:
+    build_args = ['--build-arg', f'VERSION_TAG={image_tag}',
+                  '-f', comp.dockerfile, comp.context_folder]
+    if compression != 'gzip' and not (build and push and use_buildx):
+        raise Exception(f'{compression} compression is only available when '
+                        f'building and pushing with buildx')
+    if layer_cache:
+        if not (build and use_buildx):
+            raise Exception('The layer cache is only available when building '
+                            'with buildx')
+        build_args = get_layer_cache_args(comp) + build_args
+    if build and push and use_buildx:
+        async def _build_and_push():
+            # buildx tags and uploads as part of the build itself, pushing
+            # layers as soon as they're ready.
+            async with docker_slot('PEQUOD_BUILD_CONCURRENCY'):
+                return await stream_subprocess(
+                    ['docker', 'buildx', 'build',
+                     '--output', get_registry_output(compression),
+                     '-t', full_image_name] + build_args,
+                    stdout, stderr)
+
+        return _build_and_push()
+    elif build and push:
         async def _build_and_tag_and_push():
-            await stream_subprocess(
-                ['docker', 'build', '-t', comp.image_name, '-f',
-                 comp.dockerfile, comp.context_folder],
-                stdout, stderr)
-            await stream_subprocess(
-                ['docker', 'tag', comp.image_name, full_image_name],
-                stdout, stderr)
-            await stream_subprocess(['docker', 'push', full_image_name],
-                                    stdout, stderr)
+            async with docker_slot('PEQUOD_BUILD_CONCURRENCY'):
+                rc = await stream_subprocess(
+                    ['docker', 'build', '-t', comp.image_name,
+                     '-t', full_image_name] + build_args,
+                    stdout, stderr)
+            if rc:
+                return rc
+            async with docker_slot('PEQUOD_PUSH_CONCURRENCY'):
+                return await stream_subprocess(
+                    ['docker', 'push', full_image_name], stdout, stderr)
 
         return _build_and_tag_and_push()
     elif build:
+        if use_buildx:
+            cmd = ['docker', 'buildx', 'build', '--load']
+        else:
+            cmd = ['docker', 'build']
+
         async def _build():
-            await stream_subprocess(
-                ['docker', 'build', '-t', comp.image_name, '-f',
-                 comp.dockerfile, comp.context_folder],
-                stdout, stderr)
+            async with docker_slot('PEQUOD_BUILD_CONCURRENCY'):
+                return await stream_subprocess(
+                    cmd + ['-t', comp.image_name] + build_args,
+                    stdout, stderr)
 
         return _build()
     elif push:
         async def _tag_and_push():
-            await stream_subprocess(
-                ['docker', 'tag', comp.image_name, full_image_name],
-                stdout, stderr)
-            await stream_subprocess(['docker', 'push', full_image_name],
-                                    stdout, stderr)
+            if comp.image_name != full_image_name:
+                async with docker_slot():
+                    rc = await stream_subprocess(
+                        ['docker', 'tag', comp.image_name, full_image_name],
+                        stdout, stderr)
+                if rc:
+                    return rc
+            async with docker_slot('PEQUOD_PUSH_CONCURRENCY'):
+                return await stream_subprocess(
+                    ['docker', 'push', full_image_name], stdout, stderr)
 
         return _tag_and_push()
     else:
         raise Exception('Invalid operation, neither build nor push')
 
 
-def build_image(comp):
-    return compose_image_operation_command(comp, build=True, push=False)
+def get_registry_output(compression='gzip'):
+    if compression == 'gzip':
+        return 'type=registry'
+    return (f'type=registry,compression={compression},'
+            f'compression-level=3,force-compression=true')
+
+
+def get_layer_cache_dir(comp):
+    # One cache per component, so that concurrent builds never export to the
+    # same directory. The hash keeps e.g. `a.b` and `a_b` apart.
+    name_hash = hashlib.sha1(comp.name.encode('utf-8')).hexdigest()[:8]
+    return os.path.join(get_cache_dir(), 'buildx',
+                        re.sub(r'[^\w-]', '_', comp.name) + '-' + name_hash)
+
+
+def get_layer_cache_args(comp):
+    cache_dir = get_layer_cache_dir(comp)
+    return ['--cache-from', f'type=local,src={cache_dir}',
+            '--cache-to', f'type=local,dest={cache_dir},mode=max']
+
+
+def get_bake_target(comp, registry_url, image_tag, compression='gzip',
+                    layer_cache=False):
+    full_image_name = '{}/{}:{}'.format(registry_url,
+                                        comp.image_name, image_tag)
+    # The dockerfile in a bake target is relative to its context, unlike
+    # `docker build -f`, so pass absolute paths for both.
+    target = {
+        'context': os.path.abspath(comp.context_folder),
+        'dockerfile': os.path.abspath(comp.dockerfile),
+        'tags': [full_image_name],
+        'args': {'VERSION_TAG': image_tag},
+        'output': [get_registry_output(compression)],
+    }
+    if layer_cache:
+        cache_dir = get_layer_cache_dir(comp)
+        target['cache-from'] = [f'type=local,src={cache_dir}']
+        target['cache-to'] = [f'type=local,dest={cache_dir},mode=max']
+    return target
+
+
+async def bake_images(targets):
+    # BuildKit builds all of a bake's targets at once, so bake them in
+    # batches to keep to PEQUOD_BUILD_CONCURRENCY.
+    names = list(targets)
+    size = get_concurrency_limit('PEQUOD_BUILD_CONCURRENCY')
+    rcs = []
+    for i in range(0, len(names), size):
+        batch = {name: targets[name] for name in names[i:i + size]}
+        rcs.append(await bake_targets(batch))
+    return rcs
+
+
+async def bake_targets(targets):
+    stdout = mkprint(label='bake')
+    stderr = mkprint(label='bake', file=sys.stderr)
+    bake_file = {
+        'group': {'default': {'targets': list(targets)}},
+        'target': targets,
+    }
+    with tempfile.NamedTemporaryFile('w', prefix='pequod-bake-',
+                                     suffix='.json', delete=False) as f:
+        json.dump(bake_file, f)
+    try:
+        async with docker_slot():
+            rc = await stream_subprocess(
+                ['docker', 'buildx', 'bake', '-f', f.name], stdout, stderr)
+        return rc
+    finally:
+        os.remove(f.name)
+
+
+FROM_RE = re.compile(r'^\s*FROM\s+(?:--\S+\s+)*(\S+)(?:\s+AS\s+(\S+))?',
+                     re.IGNORECASE | re.MULTILINE)
+
+
+def get_base_images(comp):
+    with open(comp.dockerfile) as f:
+        dockerfile = f.read()
+    images = []
+    stages = set()
+    for image, stage in FROM_RE.findall(dockerfile):
+        # Skip references to earlier build stages, and anything that needs
+        # build args to resolve.
+        if (image.lower() not in stages and image != 'scratch' and
+                '$' not in image):
+            images.append(image)
+        if stage:
+            stages.add(stage.lower())
+    return images
+
+
+async def prewarm_base_images(components):
+    images = []
+    for comp in components:
+        # A Dockerfile that can't be read is left for the build itself to
+        # fail on, with docker's return code.
+        try:
+            base_images = get_base_images(comp)
+        except OSError as e:
+            print(f'{comp.name}: not prewarming: {e}', file=sys.stderr)
+            continue
+        images.extend(_ for _ in base_images if _ not in images)
+    return await asyncio.gather(*(pull_image(image) for image in images))
+
+
+async def pull_image(image):
+    async with docker_slot():
+        return await stream_subprocess(['docker', 'pull', image],
+                                       mkprint(label=image),
+                                       mkprint(label=image, file=sys.stderr))
+
+
+async def run_after_prewarm(components, awaitable):
+    # Pull all of the base images concurrently up front, rather than having
+    # each build pull its own in turn.
+    await prewarm_base_images(components)
+    return await awaitable
+
+
+def build_image(comp, version_tag=None, use_buildx=False, layer_cache=False):
+    return compose_image_operation_command(
+        comp, build=True, push=False, image_tag=version_tag,
+        use_buildx=use_buildx, layer_cache=layer_cache)
 
 
 def tag_and_push_image(comp, registry_url, image_tag):
@@ -508,16 +1065,33 @@ def tag_and_push_image(comp, registry_url, image_tag):
         build=False, push=True, image_tag=image_tag)
 
 
-def build_and_tag_and_push_image(comp, registry_url, image_tag):
+def build_and_tag_and_push_image(comp, registry_url, image_tag,
+                                 use_buildx=False, compression='gzip',
+                                 layer_cache=False):
     return compose_image_operation_command(
         comp, registry_url=registry_url,
-        build=True, push=True, image_tag=image_tag)
+        build=True, push=True, image_tag=image_tag, use_buildx=use_buildx,
+        compression=compression, layer_cache=layer_cache)
 
 
 def normalize_components(component_names):
-    items = {component_items_by_name[name] for name in component_names}
-    return list(chain(*(item.get_components() for item in items)))
+    # Components come out in the order they were asked for, each only once
+    # even if it's in more than one of the named groups. Naming nothing
+    # means everything. Unsupported components are reported here, once, and
+    # left out.
+    component_items_by_name = get_component_items_by_name()
+    components = {}
+    for name in component_names or ['all']:
+        for comp in component_items_by_name[name].get_components():
+            components.setdefault(comp.name, comp)
+    supported = []
+    for comp in components.values():
+        if comp.is_supported:
+            supported.append(comp)
+        else:
+            print("{} is not currently supported".format(comp.name))
+    return supported
 
 
 if __name__ == '__main__':
-    run(config)
+    run()
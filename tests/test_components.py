@@ -0,0 +1,145 @@
+import contextlib
+import glob
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import pequod
+
+
+CONFIG = {
+    'components': [
+        {'name': 'example1', 'image_name': 'ex1',
+         'dockerfile': 'example1/Dockerfile', 'comp_type': 'app'},
+        {'name': 'example2', 'image_name': 'ex2',
+         'dockerfile': 'example2/Dockerfile', 'comp_type': 'app'},
+    ],
+    'groups': [
+        {'name': 'both', 'includes': ['example1', 'example2']},
+    ],
+}
+
+CONFIG_YAML = """\
+components:
+  - name: example1
+    image_name: ex1
+    dockerfile: example1/Dockerfile
+    comp_type: app
+  - name: example2
+    image_name: ex2
+    dockerfile: example2/Dockerfile
+    comp_type: app
+groups:
+  - name: both
+    includes: [example1, example2]
+"""
+
+
+class LoadComponentsTest(unittest.TestCase):
+    def test_config_defined_group_loads(self):
+        items_by_name = pequod.load_components(CONFIG)
+        self.assertIsInstance(items_by_name['both'], pequod.ComponentGroup)
+        self.assertEqual(['example1', 'example2'],
+                         items_by_name['both'].includes)
+
+    def test_builtin_groups_flatten(self):
+        items_by_name = pequod.load_components(CONFIG)
+        self.assertEqual(['example1', 'example2'],
+                         [c.name for c in items_by_name['all']
+                          .get_components()])
+        self.assertEqual(['example1', 'example2'],
+                         [c.name for c in items_by_name['app']
+                          .get_components()])
+
+
+class NormalizeComponentsTest(unittest.TestCase):
+    def setUp(self):
+        self.items_by_name = pequod.load_components(CONFIG)
+        patcher = mock.patch.object(pequod, 'get_component_items_by_name',
+                                    return_value=self.items_by_name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def names(self, component_names):
+        return [c.name for c in pequod.normalize_components(component_names)]
+
+    def test_order_follows_arguments_without_duplicates(self):
+        self.assertEqual(['example2', 'example1'],
+                         self.names(['example2', 'all']))
+        self.assertEqual(['example1', 'example2'],
+                         self.names(['app', 'all', 'example1']))
+
+    def test_nothing_means_all(self):
+        self.assertEqual(['example1', 'example2'], self.names([]))
+
+    def test_unsupported_are_left_out(self):
+        self.items_by_name['example1'].is_supported = False
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.assertEqual(['example2'], self.names(['example1', 'all']))
+        self.assertEqual('example1 is not currently supported\n',
+                         out.getvalue())
+
+
+class ConfigCacheTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.conf_file = os.path.join(self.tmp, 'pequod.yaml')
+        with open(self.conf_file, 'w') as f:
+            f.write(CONFIG_YAML)
+        patcher = mock.patch.dict(os.environ, {'XDG_CACHE_HOME': self.tmp})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def cache_files(self):
+        return glob.glob(os.path.join(self.tmp, 'pequod', 'components-*.pkl'))
+
+    def test_second_load_comes_from_the_cache(self):
+        pequod.load_config_and_components(self.conf_file)
+        self.assertEqual(1, len(self.cache_files()))
+        with mock.patch.object(pequod, 'load_config_file',
+                               side_effect=AssertionError('not cached')):
+            config, items_by_name = pequod.load_config_and_components(
+                self.conf_file)
+        self.assertIn('both', items_by_name)
+
+    def test_edited_config_is_reloaded(self):
+        pequod.load_config_and_components(self.conf_file)
+        stale = self.cache_files()
+        with open(self.conf_file, 'a') as f:
+            f.write('registry_url: reg.example.com\n')
+        config, items_by_name = pequod.load_config_and_components(
+            self.conf_file)
+        self.assertEqual('reg.example.com', config['registry_url'])
+        cache_files = self.cache_files()
+        self.assertEqual(1, len(cache_files))
+        self.assertNotIn(stale[0], cache_files)
+
+
+class InfoTest(unittest.TestCase):
+    def test_info_with_config_defined_group(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, 'pequod.yaml'), 'w') as f:
+                f.write(CONFIG_YAML)
+            cwd = os.getcwd()
+            os.chdir(tmp)
+            try:
+                with mock.patch.dict(os.environ,
+                                     {'XDG_CACHE_HOME': tmp}):
+                    pequod.get_config_and_components.cache_clear()
+                    out = io.StringIO()
+                    with contextlib.redirect_stdout(out):
+                        pequod.cmd_info()
+            finally:
+                os.chdir(cwd)
+                pequod.get_config_and_components.cache_clear()
+        self.assertIn('  both\n', out.getvalue())
+        self.assertIn('  example1\n', out.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
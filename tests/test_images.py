@@ -0,0 +1,63 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import pequod
+
+
+def make_component(name, dockerfile='Dockerfile'):
+    return pequod.Component(name=name, image_name=name,
+                            dockerfile=dockerfile)
+
+
+class LayerCacheDirTest(unittest.TestCase):
+    def test_similar_names_get_different_dirs(self):
+        with mock.patch.dict(os.environ, {'XDG_CACHE_HOME': '/cache'}):
+            dot = pequod.get_layer_cache_dir(make_component('a.b'))
+            underscore = pequod.get_layer_cache_dir(make_component('a_b'))
+        self.assertNotEqual(dot, underscore)
+        self.assertEqual('/cache/pequod/buildx', os.path.dirname(dot))
+        self.assertEqual('/cache/pequod/buildx', os.path.dirname(underscore))
+
+    def test_dir_is_stable(self):
+        self.assertEqual(pequod.get_layer_cache_dir(make_component('a.b')),
+                         pequod.get_layer_cache_dir(make_component('a.b')))
+
+
+class GetBaseImagesTest(unittest.TestCase):
+    def get_base_images(self, dockerfile):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'Dockerfile')
+            with open(path, 'w') as f:
+                f.write(dockerfile)
+            return pequod.get_base_images(make_component('c', path))
+
+    def test_multi_stage_skips_earlier_stages(self):
+        images = self.get_base_images(
+            'FROM golang:1 AS Build\n'
+            'RUN go build\n'
+            'FROM gcr.io/distroless/base as runtime\n'
+            'COPY --from=build /app /app\n'
+            'FROM build\n'
+            'FROM RUNTIME\n')
+        self.assertEqual(['golang:1', 'gcr.io/distroless/base'], images)
+
+    def test_platform_flag(self):
+        images = self.get_base_images(
+            'FROM --platform=$BUILDPLATFORM golang:1.21 AS build\n'
+            'FROM --platform=linux/amd64 alpine:3\n')
+        self.assertEqual(['golang:1.21', 'alpine:3'], images)
+
+    def test_arg_images_and_scratch_are_skipped(self):
+        images = self.get_base_images(
+            'ARG BASE=ubuntu:22.04\n'
+            'FROM ${BASE}\n'
+            'FROM $BASE AS other\n'
+            'FROM scratch\n'
+            'FROM debian:12\n')
+        self.assertEqual(['debian:12'], images)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import asyncio
+import unittest
+
+import pequod
+
+
+def read_chunks(chunks):
+    received = []
+
+    async def read():
+        stream = asyncio.StreamReader()
+        for chunk in chunks:
+            stream.feed_data(chunk)
+        stream.feed_eof()
+        await pequod.read_stream(stream, received.append)
+
+    asyncio.run(read())
+    return received
+
+
+class ReadStreamTest(unittest.TestCase):
+    def test_chunk_ending_mid_line(self):
+        received = read_chunks([b'one\ntw', b'o\nthr', b'ee\n'])
+        self.assertEqual(b'one\ntwo\nthree\n', b''.join(received))
+        for data in received:
+            self.assertTrue(data.endswith(b'\n'), data)
+
+    def test_final_line_without_newline(self):
+        received = read_chunks([b'one\n', b'two'])
+        self.assertEqual(b'one\ntwo', b''.join(received))
+        self.assertEqual(b'two', received[-1])
+        for data in received[:-1]:
+            self.assertTrue(data.endswith(b'\n'), data)
+
+    def test_line_longer_than_a_read(self):
+        long_line = b'x' * (200 * 1024) + b'\n'
+        received = read_chunks([long_line[:1000], long_line[1000:],
+                                b'short\n'])
+        self.assertEqual(long_line + b'short\n', b''.join(received))
+        self.assertEqual(long_line, received[0][:len(long_line)])
+        for data in received:
+            self.assertTrue(data.endswith(b'\n'), data)
+
+    def test_no_callback(self):
+        async def read():
+            stream = asyncio.StreamReader()
+            stream.feed_data(b'ignored\n')
+            stream.feed_eof()
+            await pequod.read_stream(stream, None)
+
+        asyncio.run(read())
+
+
+if __name__ == '__main__':
+    unittest.main()